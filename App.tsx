@@ -1,5 +1,5 @@
 import React, { useState, useEffect, useMemo, useCallback } from 'react';
-import { Analysis, Category, Question, UserAnswer, TestResults, SubmitResponse } from './types';
+import { Analysis, Category, Question, UserAnswer, TestResults, SubmitStreamFrame } from './types';
 import { BrainIcon, SpeechBubbleIcon, PatternIcon, CubeIcon, CalculatorIcon, MagnifyingGlassIcon } from './components/icons.tsx';
 
 type Screen = 'selection' | 'test' | 'loading' | 'results';
@@ -412,11 +412,46 @@ const App = () => {
                 const err = await response.json();
                 throw new Error(err.detail || 'Failed to submit test');
             }
+            if (!response.body) {
+                throw new Error('Failed to submit test');
+            }
 
-            const data: SubmitResponse = await response.json();
+            // Scores arrive first, so show the results screen while the analysis is still streaming
+            const handleFrame = (frame: SubmitStreamFrame) => {
+                switch (frame.type) {
+                    case 'results':
+                        setTestResults(frame.results); // This will show the real scores
+                        setScreen('results');
+                        break;
+                    case 'analysis':
+                        setAnalysis(frame.analysis); // This will show the AI analysis
+                        break;
+                    case 'error':
+                        throw new Error(frame.detail);
+                }
+            };
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffered = '';
+            let receivedAnalysis = false;
+            while (true) {
+                const { done, value } = await reader.read();
+                buffered += decoder.decode(value, { stream: !done });
+                const lines = buffered.split('\n');
+                buffered = lines.pop() ?? '';
+                for (const line of lines) {
+                    if (!line.trim()) continue;
+                    const frame: SubmitStreamFrame = JSON.parse(line);
+                    if (frame.type === 'analysis') receivedAnalysis = true;
+                    handleFrame(frame);
+                }
+                if (done) break;
+            }
 
-            setTestResults(data.results); // This will show the real scores
-            setAnalysis(data.analysis); // This will show the AI analysis
+            if (!receivedAnalysis) {
+                throw new Error('The analysis stream ended unexpectedly.');
+            }
 
         } catch (e) {
             if (e instanceof Error) setError(e.message);
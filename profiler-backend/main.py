@@ -1,12 +1,20 @@
-import json
+import asyncio
+import functools
 import os
 import random
+import sys
+import tempfile
 import time
-from fastapi import FastAPI, HTTPException, Body
+import uuid
+import msgspec
+import orjson
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Body, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import List, Dict, Any
-import google.generativeai as genai
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Annotated, List, Dict, Any, Optional
+from diskcache import Cache
 from dotenv import load_dotenv
 
 # --- 1. Initial Setup ---
@@ -15,12 +23,43 @@ load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     print("CRITICAL ERROR: GEMINI_API_KEY not found in .env file.")
-else:
-    genai.configure(api_key=GEMINI_API_KEY)
+
+# Gemini analyses keyed by the score payload, so repeat score distributions skip the API call
+ANALYSIS_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+analysis_cache = Cache("./.analysis_cache")
+
+GEMINI_MODEL_NAME = 'gemini-2.5-flash-preview-09-2025'
+
+# Deferred analyses are queued and flushed to the Gemini Batch API (half the per-request cost)
+DEFERRED_QUEUE_PREFIX = "deferred-queue"
+DEFERRED_STATUS_PREFIX = "deferred-status"
+DEFERRED_JOB_PREFIX = "deferred-job"
+DEFERRED_JOBS_KEY = "deferred-jobs" # In-flight job names; only written while holding the flush lock
+DEFERRED_STAGED_KEY = "deferred-staged" # Items pulled off the queue whose batch job isn't created yet
+DEFERRED_LOCK_KEY = "deferred-flush-lock"
+DEFERRED_LOCK_SECONDS = 10 * 60
+DEFERRED_MAX_POLL_FAILURES = 10
+DEFERRED_FLUSH_INTERVAL_SECONDS = 60
+DEFERRED_BATCH_MAX_SIZE = 500
+BATCH_FINISHED_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    worker = asyncio.create_task(deferred_analysis_worker()) if GEMINI_API_KEY else None
+    yield
+    if worker:
+        worker.cancel()
 
 app = FastAPI(
     title="Cognitive Profiler Backend",
-    description="The secure 'brain' for the React Cognitive Profiler app."
+    description="The secure 'brain' for the React Cognitive Profiler app.",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -30,15 +69,16 @@ app.add_middleware(
         "https://profiler-frontend-two.vercel.app" # <-- ADD THIS LINE
     ],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
+    max_age=7200, # Let browsers reuse preflights (Chromium caps this at 2h)
 )
 
 # --- 2. Load Data ---
 
 try:
-    with open("questions.json", "r") as f:
-        QUESTION_BANK = json.load(f)
+    with open("questions.json", "rb") as f:
+        QUESTION_BANK = orjson.loads(f.read())
 except Exception as e:
     print(f"CRITICAL ERROR: Could not load questions.json: {e}")
     QUESTION_BANK = []
@@ -51,6 +91,8 @@ CATEGORY_METADATA = {
     "Numerical Reasoning": {"id": "numerical-reasoning", "description": "Solving problems with numbers.", "icon": "calculator"},
     "Attention to Detail": {"id": "attention-to-detail", "description": "Focusing on the small particulars.", "icon": "search"}
 }
+# Titles and the bank's category strings are interned so category-keyed lookups match by identity
+CATEGORY_METADATA = {sys.intern(title): meta for title, meta in CATEGORY_METADATA.items()}
 
 ID_TO_TITLE_MAP = {
     meta["id"]: title
@@ -58,50 +100,122 @@ ID_TO_TITLE_MAP = {
 }
 
 try:
+    for q in QUESTION_BANK:
+        q["category"] = sys.intern(q["category"])
     ANSWER_KEY = {q["id"]: q["correctAnswerIndex"] for q in QUESTION_BANK}
     CATEGORY_KEY = {q["id"]: q["category"] for q in QUESTION_BANK}
+    # Client-facing question dicts (no answer index), built once and reused by /start-test
+    QUESTION_DICTS_BY_ID = {
+        q["id"]: {
+            "id": q["id"],
+            "category": q["category"],
+            "questionText": q["questionText"],
+            "options": q["options"]
+        }
+        for q in QUESTION_BANK
+    }
 except KeyError as e:
     print(f"ERROR in questions.json: A question is missing 'id' or 'correctAnswerIndex': {e}")
     ANSWER_KEY = {}
     CATEGORY_KEY = {}
+    QUESTION_DICTS_BY_ID = {}
+
+# Index question ids by category once so requests don't rescan the bank
+QUESTION_IDS_BY_CATEGORY: Dict[str, List[int]] = {}
+for q in QUESTION_DICTS_BY_ID.values():
+    QUESTION_IDS_BY_CATEGORY.setdefault(q["category"], []).append(q["id"])
+
+AVAILABLE_CATEGORIES = frozenset(QUESTION_IDS_BY_CATEGORY.keys())
+
+# Small integer ids per category so the grader can tally into flat lists
+CATEGORY_NAMES = list(QUESTION_IDS_BY_CATEGORY.keys())
+CATEGORY_TO_IDX = {name: i for i, name in enumerate(CATEGORY_NAMES)}
+CATEGORY_IDX_KEY = {q_id: CATEGORY_TO_IDX[category] for q_id, category in CATEGORY_KEY.items()}
+
+# The /categories body never changes at runtime, so serialize it once
+CATEGORIES_JSON_BYTES = orjson.dumps([
+    {
+        "id": meta["id"],
+        "title": title,
+        "description": meta["description"],
+        "icon": meta["icon"]
+    }
+    for title, meta in CATEGORY_METADATA.items()
+    if title in AVAILABLE_CATEGORIES
+])
+# Headers are static too. Allow-Origin is left to CORSMiddleware, since a blanket "*" would
+# bypass the origin allowlist.
+CATEGORIES_HEADERS = {"content-type": "application/json"}
 
 # --- 3. Pydantic Models (Our Data "Contracts") ---
 
-class Category(BaseModel):
+class ContractModel(BaseModel):
+    # Contracts are never mutated after validation; unknown fields are dropped
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+class Category(ContractModel):
     id: str
     title: str
     description: str
     icon: str
 
-class StartTestRequest(BaseModel):
+class StartTestRequest(ContractModel):
     categories: List[str] = Field(..., min_length=1)
 
-class QuestionResponse(BaseModel):
+class QuestionResponse(ContractModel):
     id: int
     category: str
     questionText: str
     options: List[str]
 
-class QuizResponse(BaseModel):
+class QuizResponse(ContractModel):
     questions: List[QuestionResponse]
     timeLimitSeconds: int
 
-class Answer(BaseModel):
+# Submissions are decoded with msgspec rather than Pydantic: one Answer per question
+# per request makes model construction the dominant cost on /submit-test
+
+class Answer(msgspec.Struct, frozen=True):
     questionId: int
     selectedOption: int
 
-class SubmitTestRequest(BaseModel):
-    answers: List[Answer]
+class SubmitTestRequest(msgspec.Struct, frozen=True):
+    # Quizzes top out at 30 questions; rejects oversized payloads before grading
+    answers: Annotated[List[Answer], msgspec.Meta(max_length=60)]
+
+# Built once and reused, so the type's validation plan isn't looked up on every submission
+SUBMIT_REQUEST_DECODER = msgspec.json.Decoder(SubmitTestRequest)
+
+def inline_schema_refs(node, defs):
+    # msgspec points refs at "#/$defs/...", which don't resolve inside an OpenAPI document
+    if isinstance(node, dict):
+        if "$ref" in node:
+            return inline_schema_refs(defs[node["$ref"].rsplit("/", 1)[-1]], defs)
+        return {key: inline_schema_refs(value, defs) for key, value in node.items() if key != "$defs"}
+    if isinstance(node, list):
+        return [inline_schema_refs(item, defs) for item in node]
+    return node
+
+# The submit endpoints read the raw body, so their request schema is documented by hand
+_submit_request_schema = msgspec.json.schema(SubmitTestRequest)
+SUBMIT_REQUEST_OPENAPI = {
+    "requestBody": {
+        "content": {"application/json": {
+            "schema": inline_schema_refs(_submit_request_schema, _submit_request_schema["$defs"])
+        }},
+        "required": True
+    }
+}
 
-class CategoryScoreInput(BaseModel):
+class CategoryScoreInput(ContractModel):
     category: str
     score: str
 
-class AIAnalysisRequest(BaseModel):
+class AIAnalysisRequest(ContractModel):
     overall_score: str
     category_scores: List[CategoryScoreInput]
 
-class AIAnalysisResponse(BaseModel):
+class AIAnalysisResponse(ContractModel):
     title: str
     overall_summary: str
     strengths_analysis: str
@@ -110,18 +224,22 @@ class AIAnalysisResponse(BaseModel):
 
 # --- NEW: Models to send back the combined results ---
 
-class CategoryResult(BaseModel):
+class CategoryResult(ContractModel):
     correct: int
     total: int
 
-class TestResults(BaseModel):
+class TestResults(ContractModel):
     totalCorrect: int
     totalQuestions: int
     categoryResults: Dict[str, CategoryResult]
 
-class SubmitResponse(BaseModel):
+class DeferredSubmitResponse(ContractModel):
+    submissionId: str
     results: TestResults
-    analysis: AIAnalysisResponse
+
+class DeferredAnalysisStatus(ContractModel):
+    status: str
+    analysis: Optional[AIAnalysisResponse] = None
 
 # --- END OF NEW MODELS ---
 
@@ -153,30 +271,40 @@ The output JSON object MUST have this exact structure:
 """
 
 
-model = genai.GenerativeModel(
-    model_name='gemini-2.5-flash-preview-09-2025',
-    generation_config=genai.GenerationConfig(
-        response_mime_type="application/json"
+@functools.lru_cache(maxsize=1)
+def get_model():
+    # The Gemini SDK (grpc, protobuf, ...) is imported on first use, so workers that only
+    # serve /categories and /start-test never load it
+    import google.generativeai as genai
+
+    genai.configure(api_key=GEMINI_API_KEY)
+    # The system prompt is set once on the model instead of being resent as content on every call
+    return genai.GenerativeModel(
+        model_name=GEMINI_MODEL_NAME,
+        system_instruction=AI_SYSTEM_PROMPT,
+        generation_config=genai.GenerationConfig(
+            response_mime_type="application/json"
+        )
     )
-)
+
+quiz_rng = random.Random()
+
+def sample_ids(pool: List[int], k: int) -> List[int]:
+    # Partial Fisher-Yates: only the first k slots get shuffled, no set bookkeeping
+    ids = pool[:]
+    for i in range(k):
+        j = quiz_rng.randrange(i, len(ids))
+        ids[i], ids[j] = ids[j], ids[i]
+    return ids[:k]
 
 # --- 4. API Endpoints ---
 
-@app.get("/categories", response_model=List[Category])
+@app.get("/categories", responses={200: {"model": List[Category]}})
 async def get_categories():
-    categories = [
-        Category(
-            id=meta["id"],
-            title=title,
-            description=meta["description"],
-            icon=meta["icon"]
-        )
-        for title, meta in CATEGORY_METADATA.items()
-        if title in {q["category"] for q in QUESTION_BANK}
-    ]
-    return categories
+    return Response(content=CATEGORIES_JSON_BYTES, headers=CATEGORIES_HEADERS)
 
-@app.post("/start-test", response_model=QuizResponse)
+# Responses are returned pre-serialized; `responses=` keeps the schema in the docs
+@app.post("/start-test", responses={200: {"model": QuizResponse}})
 async def start_test(request: StartTestRequest):
     selected_ids = request.categories
     num_categories = len(selected_ids)
@@ -196,105 +324,392 @@ async def start_test(request: StartTestRequest):
     questions_per_category = TOTAL_QUESTIONS // num_categories
     remainder = TOTAL_QUESTIONS % num_categories
 
-    final_quiz_list = []
+    final_quiz_ids = []
     
     for i, title in enumerate(selected_titles):
         num_to_pick = questions_per_category
         if i < remainder:
             num_to_pick += 1
         
-        category_pool = [q for q in QUESTION_BANK if q["category"] == title]
+        category_pool = QUESTION_IDS_BY_CATEGORY.get(title, [])
         num_available = len(category_pool)
         actual_num_to_pick = min(num_to_pick, num_available)
         
-        selected_questions = random.sample(category_pool, actual_num_to_pick)
-        final_quiz_list.extend(selected_questions)
+        picked_ids = sample_ids(category_pool, actual_num_to_pick)
+        final_quiz_ids.extend(picked_ids)
 
-    random.shuffle(final_quiz_list)
+    quiz_rng.shuffle(final_quiz_ids)
 
-    formatted_quiz_list = [QuestionResponse(**q) for q in final_quiz_list]
+    # Questions are static, so skip QuestionResponse and reuse the prebuilt dicts
+    payload = {
+        "questions": [QUESTION_DICTS_BY_ID[qid] for qid in final_quiz_ids],
+        "timeLimitSeconds": time_limit_seconds
+    }
 
-    return QuizResponse(
-        questions=formatted_quiz_list,
-        timeLimitSeconds=time_limit_seconds
-    )
+    return ORJSONResponse(content=payload)
 
-# --- UPDATED SUBMIT_TEST ---
-@app.post("/submit-test", response_model=SubmitResponse)
-async def submit_test(request: SubmitTestRequest):
+async def read_submit_request(request: Request) -> SubmitTestRequest:
+    try:
+        return SUBMIT_REQUEST_DECODER.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid submission: {e}")
+
+def grade_answers(answers: List[Answer]):
     if not ANSWER_KEY or not CATEGORY_KEY:
         raise HTTPException(status_code=500, detail="Server error: Answer key not loaded.")
 
     # --- 1. The "Grader" ---
-    total_correct = 0
-    total_questions = len(request.answers)
-    category_scores_dict: Dict[str, Dict[str, int]] = {} 
+    total_questions = len(answers)
+    correct = [0] * len(CATEGORY_NAMES)
+    total = [0] * len(CATEGORY_NAMES)
 
-    for answer in request.answers:
+    for answer in answers:
         q_id = answer.questionId
-        if q_id not in ANSWER_KEY or q_id not in CATEGORY_KEY:
+        idx = CATEGORY_IDX_KEY.get(q_id, -1)
+        if idx < 0:
             continue 
 
-        category = CATEGORY_KEY[q_id]
-        correct_answer_index = ANSWER_KEY[q_id]
-
-        if category not in category_scores_dict:
-            category_scores_dict[category] = {"correct": 0, "total": 0}
-        
-        category_scores_dict[category]["total"] += 1
-        
-        is_correct = (answer.selectedOption == correct_answer_index)
-        if is_correct:
-            total_correct += 1
-            category_scores_dict[category]["correct"] += 1
+        total[idx] += 1
+        correct[idx] += (answer.selectedOption == ANSWER_KEY[q_id])
 
     if total_questions == 0:
         raise HTTPException(status_code=400, detail="No answers provided.")
+
+    total_correct = sum(correct)
+    category_scores = [
+        (CATEGORY_NAMES[idx], correct[idx], total[idx])
+        for idx in range(len(CATEGORY_NAMES))
+        if total[idx] > 0
+    ]
     
     # --- Create the Pydantic-compatible TestResults object ---
-    results = TestResults(
+    # All values are computed server-side, so skip re-validation with model_construct
+    results = TestResults.model_construct(
         totalCorrect=total_correct,
         totalQuestions=total_questions,
         categoryResults={
-            cat_name: CategoryResult(**scores)
-            for cat_name, scores in category_scores_dict.items()
+            cat_name: CategoryResult.model_construct(correct=cat_correct, total=cat_total)
+            for cat_name, cat_correct, cat_total in category_scores
         }
     )
 
-    # --- 2. The "AI Analyst" ---
-    ai_request_data = AIAnalysisRequest(
+    # --- 2. The "AI Analyst" input ---
+    ai_request_data = AIAnalysisRequest.model_construct(
         overall_score=f"{total_correct}/{total_questions}",
         category_scores=[
-            CategoryScoreInput(
+            CategoryScoreInput.model_construct(
                 category=cat_name,
-                score=f"{scores['correct']}/{scores['total']}"
-            ) for cat_name, scores in category_scores_dict.items() if scores['total'] > 0
+                score=f"{cat_correct}/{cat_total}"
+            ) for cat_name, cat_correct, cat_total in category_scores
         ]
     )
 
-    # --- 3. Call Gemini API ---
+    return results, ai_request_data
+
+def analysis_cache_key(ai_request_data: AIAnalysisRequest) -> bytes:
+    # The grader emits categories in CATEGORY_NAMES order, so equal scores give equal keys as-is
+    return orjson.dumps([
+        ai_request_data.overall_score,
+        [(c.category, c.score) for c in ai_request_data.category_scores]
+    ])
+
+def ndjson_frame(frame: Dict[str, Any]) -> bytes:
+    return orjson.dumps(frame) + b"\n"
+
+async def stream_submission(results_payload: Dict[str, Any], ai_request_data: AIAnalysisRequest, cache_key: bytes):
+    # The results frame goes out before Gemini is even called, so the client can render scores first
+    yield ndjson_frame({"type": "results", "results": results_payload})
+
+    # --- 3. Reuse a cached analysis for the same scores ---
+    # Cache calls go through a thread: they can wait on the sqlite lock held by the flush worker
+    cached_analysis = await asyncio.to_thread(analysis_cache.get, cache_key)
+    if cached_analysis is not None:
+        yield ndjson_frame({"type": "analysis", "analysis": cached_analysis})
+        return
+
+    # --- 4. Call Gemini API ---
     try:
-        response = model.generate_content(
-            [AI_SYSTEM_PROMPT, ai_request_data.model_dump_json()]
-        )
-        result_json = json.loads(response.text)
-        final_analysis = AIAnalysisResponse(**result_json)
-        
-        # --- 4. Return the COMBINED object ---
-        return SubmitResponse(
-            results=results,
-            analysis=final_analysis
+        # The first call imports the SDK, so resolve the model off the event loop
+        model = await asyncio.to_thread(get_model)
+        # Async client call, so the event loop keeps serving other requests meanwhile
+        response = await model.generate_content_async(
+            orjson.dumps(ai_request_data.model_dump()).decode()
         )
-    
+        # Gemini output is untrusted, so this one still goes through validation
+        result_json = orjson.loads(response.text.encode())
+        final_analysis = AIAnalysisResponse.model_validate(result_json)
+
     except Exception as e:
         print(f"Gemini API call failed: {e}")
+        # Headers are already sent, so the failure is reported in-band
+        yield ndjson_frame({
+            "type": "error",
+            "detail": "The AI analysis service is currently unavailable. Please try again later."
+        })
+        return
+
+    # --- 5. Send the validated analysis, then cache it ---
+    analysis_payload = final_analysis.model_dump()
+    yield ndjson_frame({"type": "analysis", "analysis": analysis_payload})
+
+    try:
+        await asyncio.to_thread(
+            analysis_cache.set, cache_key, analysis_payload, expire=ANALYSIS_CACHE_TTL_SECONDS
+        )
+    except Exception as e:
+        print(f"Could not cache analysis: {e}")
+
+# --- UPDATED SUBMIT_TEST ---
+# Streams NDJSON frames: a "results" frame as soon as grading is done, then a final
+# "analysis" (validated) or "error" frame once Gemini answers.
+@app.post("/submit-test", responses={200: {
+    "description": "NDJSON stream of a results frame followed by an analysis or error frame",
+    "content": {"application/x-ndjson": {}}
+}}, openapi_extra=SUBMIT_REQUEST_OPENAPI)
+async def submit_test(request: Request):
+    submission = await read_submit_request(request)
+    results, ai_request_data = grade_answers(submission.answers)
+
+    return StreamingResponse(
+        stream_submission(results.model_dump(), ai_request_data, analysis_cache_key(ai_request_data)),
+        media_type="application/x-ndjson"
+    )
+
+# --- DEFERRED SUBMIT_TEST (Gemini Batch API) ---
+# For non-interactive flows (e.g. bulk re-scoring): grade now, analyse later in a batch job.
+# The queue, in-flight batch jobs and results live in the disk cache, so every uvicorn worker
+# shares them and a restart does not strand in-flight batch jobs.
+
+@app.post(
+    "/submit-test-deferred",
+    responses={200: {"model": DeferredSubmitResponse}},
+    openapi_extra=SUBMIT_REQUEST_OPENAPI
+)
+async def submit_test_deferred(request: Request):
+    submission = await read_submit_request(request)
+    results, ai_request_data = grade_answers(submission.answers)
+    submission_id = uuid.uuid4().hex
+    cache_key = analysis_cache_key(ai_request_data)
+
+    cached_analysis = await asyncio.to_thread(analysis_cache.get, cache_key)
+    if cached_analysis is not None:
+        status = {"status": "complete", "analysis": cached_analysis}
+    elif not GEMINI_API_KEY:
+        # No worker runs without a key, so nothing would ever flush the queue
         raise HTTPException(
-            status_code=500, 
+            status_code=503,
             detail="The AI analysis service is currently unavailable. Please try again later."
         )
+    else:
+        status = {"status": "pending", "analysis": None}
+        await asyncio.to_thread(
+            analysis_cache.push,
+            {
+                "submissionId": submission_id,
+                "cacheKey": cache_key,
+                "payload": orjson.dumps(ai_request_data.model_dump()).decode()
+            },
+            prefix=DEFERRED_QUEUE_PREFIX,
+            expire=ANALYSIS_CACHE_TTL_SECONDS
+        )
+    await asyncio.to_thread(set_deferred_status, submission_id, status)
+
+    return ORJSONResponse(content={
+        "submissionId": submission_id,
+        "results": results.model_dump()
+    })
+
+@app.get("/submit-test-deferred/{submission_id}", responses={200: {"model": DeferredAnalysisStatus}})
+async def get_deferred_analysis(submission_id: str):
+    status = await asyncio.to_thread(analysis_cache.get, (DEFERRED_STATUS_PREFIX, submission_id))
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown submission ID.")
+    return ORJSONResponse(content=status)
+
+def set_deferred_status(submission_id: str, status: Dict[str, Any]):
+    analysis_cache.set((DEFERRED_STATUS_PREFIX, submission_id), status, expire=ANALYSIS_CACHE_TTL_SECONDS)
+
+def fail_deferred_submissions(submission_ids):
+    for submission_id in submission_ids:
+        set_deferred_status(submission_id, {"status": "failed", "analysis": None})
+
+def submit_deferred_batch(client, genai_types):
+    """Send the queued analyses to Gemini as one batch job and record it as in flight."""
+    pending = analysis_cache.get(DEFERRED_STAGED_KEY)
+    if pending is None:
+        # Queued items are moved to the staged record in one transaction, so they stay on disk
+        # until the batch job exists
+        with analysis_cache.transact():
+            pending = []
+            while len(pending) < DEFERRED_BATCH_MAX_SIZE:
+                _, item = analysis_cache.pull(prefix=DEFERRED_QUEUE_PREFIX)
+                if item is None:
+                    break
+                pending.append(item)
+            if pending:
+                analysis_cache.set(DEFERRED_STAGED_KEY, pending, expire=ANALYSIS_CACHE_TTL_SECONDS)
+        if not pending:
+            return
+    # A staged record left over from an earlier tick means that flush died before its batch
+    # job was recorded, so it is retried here
+
+    lines = [
+        orjson.dumps({
+            "key": item["submissionId"],
+            "request": {
+                "system_instruction": {"parts": [{"text": AI_SYSTEM_PROMPT}]},
+                "contents": [{"role": "user", "parts": [{"text": item["payload"]}]}],
+                "generation_config": {"response_mime_type": "application/json"}
+            }
+        })
+        for item in pending
+    ]
+    cache_keys = {item["submissionId"]: item["cacheKey"] for item in pending}
+
+    try:
+        with tempfile.NamedTemporaryFile("wb", suffix=".jsonl", delete=False) as f:
+            f.write(b"\n".join(lines))
+        try:
+            batch_file = client.files.upload(
+                file=f.name,
+                config=genai_types.UploadFileConfig(mime_type="jsonl")
+            )
+        finally:
+            os.remove(f.name)
+
+        job = client.batches.create(model=GEMINI_MODEL_NAME, src=batch_file.name)
+    except Exception as e:
+        print(f"Gemini batch job could not be created: {e}")
+        fail_deferred_submissions(cache_keys)
+        analysis_cache.delete(DEFERRED_STAGED_KEY)
+        return
+
+    # The job is tracked on disk, not in this process, so a restart picks it up on the next tick
+    with analysis_cache.transact():
+        analysis_cache.set(
+            (DEFERRED_JOB_PREFIX, job.name),
+            {"cacheKeys": cache_keys, "pollFailures": 0},
+            expire=ANALYSIS_CACHE_TTL_SECONDS
+        )
+        analysis_cache.set(DEFERRED_JOBS_KEY, analysis_cache.get(DEFERRED_JOBS_KEY, []) + [job.name])
+        analysis_cache.delete(DEFERRED_STAGED_KEY)
+
+def collect_deferred_batch(client, job, cache_keys: Dict[str, bytes]):
+    """Store the results of a finished batch job; anything without a usable result is failed."""
+    try:
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"batch job {job.name} ended in state {job.state.name}")
+        output = client.files.download(file=job.dest.file_name)
+    except Exception as e:
+        print(f"Gemini batch job failed: {e}")
+        fail_deferred_submissions(cache_keys)
+        return
+
+    unresolved = set(cache_keys)
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        row = orjson.loads(line)
+        submission_id = row.get("key")
+        if submission_id not in unresolved:
+            continue
+        unresolved.discard(submission_id)
+        try:
+            text = row["response"]["candidates"][0]["content"]["parts"][0]["text"]
+            analysis = AIAnalysisResponse.model_validate(orjson.loads(text)).model_dump()
+        except Exception as e:
+            print(f"Gemini batch result for {submission_id} was unusable: {e}")
+            fail_deferred_submissions([submission_id])
+            continue
+        analysis_cache.set(cache_keys[submission_id], analysis, expire=ANALYSIS_CACHE_TTL_SECONDS)
+        set_deferred_status(submission_id, {"status": "complete", "analysis": analysis})
+
+    if unresolved:
+        print(f"Gemini batch job {job.name} returned no result for {len(unresolved)} submissions")
+        fail_deferred_submissions(unresolved)
+
+def poll_deferred_batches(client):
+    """Check each in-flight batch job once; its record is only deleted after its statuses are written."""
+    job_names = analysis_cache.get(DEFERRED_JOBS_KEY, [])
+    done = set()
+
+    for job_name in job_names:
+        record_key = (DEFERRED_JOB_PREFIX, job_name)
+        record = analysis_cache.get(record_key)
+        if record is None:
+            done.add(job_name)
+            continue
+
+        try:
+            job = client.batches.get(name=job_name)
+        except Exception as e:
+            poll_failures = record["pollFailures"] + 1
+            print(f"Could not poll Gemini batch job {job_name} ({poll_failures}/{DEFERRED_MAX_POLL_FAILURES}): {e}")
+            if poll_failures >= DEFERRED_MAX_POLL_FAILURES:
+                fail_deferred_submissions(record["cacheKeys"])
+                analysis_cache.delete(record_key)
+                done.add(job_name)
+            else:
+                analysis_cache.set(record_key, {**record, "pollFailures": poll_failures}, expire=ANALYSIS_CACHE_TTL_SECONDS)
+            continue
+
+        if job.state.name not in BATCH_FINISHED_STATES:
+            if record["pollFailures"]:
+                analysis_cache.set(record_key, {**record, "pollFailures": 0}, expire=ANALYSIS_CACHE_TTL_SECONDS)
+            continue
+
+        collect_deferred_batch(client, job, record["cacheKeys"])
+        analysis_cache.delete(record_key)
+        done.add(job_name)
+
+    if done:
+        analysis_cache.set(DEFERRED_JOBS_KEY, [name for name in job_names if name not in done])
+
+@functools.lru_cache(maxsize=1)
+def get_batch_client():
+    # Imported on first use, like get_model(), so idle workers never load google-genai
+    from google import genai as google_genai
+
+    return google_genai.Client(api_key=GEMINI_API_KEY)
+
+def has_deferred_work() -> bool:
+    _, queued = analysis_cache.peek(prefix=DEFERRED_QUEUE_PREFIX)
+    return (
+        queued is not None
+        or DEFERRED_STAGED_KEY in analysis_cache
+        or bool(analysis_cache.get(DEFERRED_JOBS_KEY))
+    )
+
+def flush_deferred_analyses():
+    """One worker tick: poll in-flight batch jobs, then submit whatever is queued (blocking)."""
+    if not has_deferred_work():
+        return
+    # Every uvicorn worker ticks, so only one of them flushes at a time; the lock expires in
+    # case its holder dies mid-flush
+    if not analysis_cache.add(DEFERRED_LOCK_KEY, os.getpid(), expire=DEFERRED_LOCK_SECONDS):
+        return
+    try:
+        from google.genai import types as genai_types
+
+        client = get_batch_client()
+        poll_deferred_batches(client)
+        submit_deferred_batch(client, genai_types)
+    finally:
+        analysis_cache.delete(DEFERRED_LOCK_KEY)
+
+async def deferred_analysis_worker():
+    while True:
+        await asyncio.sleep(DEFERRED_FLUSH_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(flush_deferred_analyses)
+        except Exception as e:
+            print(f"Deferred analysis flush failed: {e}")
 
 # This allows running the app with `python main.py`
 if __name__ == "__main__":
     import uvicorn
-    print("Starting FastAPI server on http://127.0.0.1:8000")
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    # WEB_CONCURRENCY is uvicorn's usual override; default to one worker per core
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 2))
+    print(f"Starting FastAPI server on http://127.0.0.1:8000 with {workers} workers")
+    # Workers need the app as an import string; uvloop/httptools ship with uvicorn[standard]
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, workers=workers, loop="uvloop", http="httptools")
\ No newline at end of file
@@ -39,7 +39,8 @@ export interface TestResults {
     [categoryName: string]: CategoryResult;
   };
 }
-export interface SubmitResponse {
-  results: TestResults;
-  analysis: Analysis;
-}
\ No newline at end of file
+// /submit-test streams newline-delimited JSON, one of these frames per line
+export type SubmitStreamFrame =
+  | { type: 'results'; results: TestResults }
+  | { type: 'analysis'; analysis: Analysis }
+  | { type: 'error'; detail: string };
\ No newline at end of file